@@ -1,6 +1,9 @@
-from openai import OpenAI
-import base64, os
+from openai import OpenAI, DefaultHttpxClient
+import base64, hashlib, os, shutil, tempfile
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 load_dotenv()  # loads OPENAI_API_KEY from .env
@@ -8,7 +11,187 @@ load_dotenv()  # loads OPENAI_API_KEY from .env
 api_key = os.getenv("OPENAI_API_KEY")
 print(f'api_key: {api_key}')
 assert api_key, "OPENAI_API_KEY is missing"
-client = OpenAI(api_key=api_key)
+# High-quality image edits can run for minutes, so keep the SDK's 600s
+# read timeout (a shorter one would trigger retries that re-bill the
+# edit). Compared with the SDK defaults this allows a slower connect
+# (10s vs 5s) and caps the pool at 64 connections / 32 keep-alive
+# (vs 1000 / 100)
+client = OpenAI(
+    api_key=api_key,
+    http_client=DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx.Timeout(600, connect=10),
+    ),
+)
+
+# Image edit settings, resolved once at import
+EDIT_MODEL = os.getenv("OPENAI_EDIT_MODEL", "gpt-image-1")
+EDIT_SIZE = "1024x1024"
+EDIT_QUALITY = "high"
+
+PROMPT_TEMPLATE = (
+    "Replace the head of this LEGO minifigure with a {animal_name} head. "
+    "Make it look like a LEGO-style {animal_name} head that fits naturally. Do not make it too realistic "
+    "Replace the shirt with a wife beater. "
+    "Add a crown on the {animal_name} head. "
+    "Replace the pants with khakis."
+    "Add a pair of cowboy boots."
+    "Make the hands/arms the same color as the {animal_name}, but still lego-style."
+    "Keep and pose exactly the same (exactly front on, no side view) "
+    "Add realistic lighting so it looks like a real LEGO figure, and get get rid of gridlines."
+    # "Maintain the same lighting and style as the original figure."
+)
+
+# Shared session so URL downloads reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3),
+))
+
+# Raw bytes of input images, keyed by path -> (mtime, bytes)
+_FILE_CACHE = {}
+
+def _load(path):
+    """
+    Read a file's bytes, reusing the cached copy while its mtime is unchanged
+    
+    Args:
+        path: Path to the file to read
+    """
+    
+    mtime = os.stat(path).st_mtime
+    entry = _FILE_CACHE.get(path)
+    if entry and entry[0] == mtime:
+        return entry[1]
+    with open(path, "rb") as f:
+        data = f.read()
+    _FILE_CACHE[path] = (mtime, data)
+    return data
+
+def _make_temp(path):
+    """
+    Create a unique temp file next to path and return (fd, temp_path)
+    
+    Args:
+        path: The file the temp will be os.replace()d onto
+    """
+    
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=f"{os.path.basename(path)}.",
+        suffix=".tmp",
+    )
+    os.chmod(temp_path, 0o644)  # mkstemp creates 0600; outputs are meant to be shared
+    return fd, temp_path
+
+B64_CHUNK = 4 * 16384  # 64KB of base64 text per decode
+
+def _save_result_image(image_data, output_filename):
+    """
+    Write an image returned by the API to disk
+    
+    Args:
+        image_data: An entry from result.data (base64 or URL)
+        output_filename: Path to write the PNG to
+    """
+    
+    if not (image_data.b64_json or image_data.url):
+        print("Error: No image data found in response")
+        return None
+    
+    # Write to a uniquely named temp file and swap it in, so a failed save
+    # never leaves a truncated PNG and concurrent writers don't collide
+    fd, temp_filename = _make_temp(output_filename)
+    
+    try:
+        with os.fdopen(fd, "wb") as f:
+            # Check if we have base64 data or URL
+            if image_data.b64_json:
+                # Decode base64 data in chunks rather than materializing the
+                # whole PNG; chunk size is a multiple of 4 so each slice is
+                # valid base64 on its own (b64_json contains no whitespace)
+                b64 = image_data.b64_json
+                for i in range(0, len(b64), B64_CHUNK):
+                    f.write(base64.b64decode(b64[i:i + B64_CHUNK]))
+                source = "base64"
+            else:
+                # Stream from URL straight to disk
+                print(f"Downloading from URL: {image_data.url}")
+                with SESSION.get(image_data.url, stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    response.raw.decode_content = True  # honor gzip/deflate encoding
+                    shutil.copyfileobj(response.raw, f, length=65536)
+                source = "URL"
+        
+        os.replace(temp_filename, output_filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+    
+    print(f"Saved: {output_filename} (from {source})")
+    return output_filename
+
+# On-disk cache of edit results, keyed by a hash of everything sent to the API
+EDIT_CACHE_DIR = ".cache/edits"
+EDIT_CACHE_MAX_ENTRIES = 256
+
+def _edit_cache_path(image_bytes, prompt, model, size, quality):
+    """
+    Return the cache path for an edit request
+    
+    Args:
+        image_bytes: Raw bytes of the input image
+        prompt: The edit prompt
+        model, size, quality: The images.edit parameters
+    """
+    
+    h = hashlib.sha256(image_bytes)
+    for part in (prompt, model, size, quality):
+        h.update(b"|" + part.encode())
+    return os.path.join(EDIT_CACHE_DIR, f"{h.hexdigest()}.png")
+
+def _link_or_copy(src, dst):
+    """
+    Hardlink src to dst (copying if linking isn't possible), replacing dst
+    
+    Args:
+        src: Existing file
+        dst: Path to place it at
+    """
+    
+    # Already the same file (e.g. a cache hit on a previously linked output);
+    # renaming a link over itself is a no-op and would strand the temp
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    
+    fd, temp_dst = _make_temp(dst)
+    os.close(fd)
+    try:
+        # os.link needs a free name; the random temp name is ours alone
+        os.remove(temp_dst)
+        try:
+            os.link(src, temp_dst)
+        except OSError:
+            # Filesystem can't hardlink here (cross-device, FUSE/SMB, ...)
+            shutil.copyfile(src, temp_dst)
+        os.replace(temp_dst, dst)
+    finally:
+        if os.path.exists(temp_dst):
+            os.remove(temp_dst)
+
+def _prune_edit_cache():
+    """
+    Drop the least recently used cache entries beyond EDIT_CACHE_MAX_ENTRIES
+    """
+    
+    entries = [e for e in os.scandir(EDIT_CACHE_DIR) if e.name.endswith(".png")]
+    if len(entries) <= EDIT_CACHE_MAX_ENTRIES:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for e in entries[:len(entries) - EDIT_CACHE_MAX_ENTRIES]:
+        os.remove(e.path)
 
 def edit_lego_head(base_image_path, animal_name):
     """
@@ -19,58 +202,54 @@ def edit_lego_head(base_image_path, animal_name):
         animal_name: The animal head to generate (e.g., "red panda", "bear")
     """
     
+    # Don't pay for an edit that has no animal to draw
+    animal_name = (animal_name or "").strip()
+    if not animal_name:
+        print("Error: No animal name given, skipping edit")
+        return None
+    
     # Create rhythmojis folder if it doesn't exist
     os.makedirs("rhythmojis", exist_ok=True)
     
-    prompt = (
-        f"Replace the head of this LEGO minifigure with a {animal_name} head. "
-        "Make it look like a LEGO-style {animal_name} head that fits naturally. Do not make it too realistic "
-        "Replace the shirt with a wife beater. "  
-        f"Add a crown on the {animal_name} head. "
-        "Replace the pants with khakis."
-        "Add a pair of cowboy boots."
-        "Make the hands/arms the same color as the {animal_name}, but still lego-style."
-        "Keep and pose exactly the same (exactly front on, no side view) "
-        "Add realistic lighting so it looks like a real LEGO figure, and get get rid of gridlines."
-        # "Maintain the same lighting and style as the original figure."
-    )
+    prompt = PROMPT_TEMPLATE.format(animal_name=animal_name)
+    output_filename = f"rhythmojis/lego_{animal_name.replace(' ', '_')}.png"
     
     try:
+        image_bytes = _load(base_image_path)
+        
+        # Reuse a previous result for the identical request; if the entry
+        # vanishes (e.g. pruned by another process), just edit afresh
+        cache_path = _edit_cache_path(image_bytes, prompt, EDIT_MODEL, EDIT_SIZE, EDIT_QUALITY)
+        if os.path.exists(cache_path):
+            try:
+                _link_or_copy(cache_path, output_filename)
+                os.utime(cache_path)  # mark as recently used
+                print(f"Saved: {output_filename} (from cache)")
+                return output_filename
+            except OSError as e:
+                print(f"Warning: could not use edit cache: {e}")
+        
         result = client.images.edit(
-            model="gpt-image-1",
-            image=open(base_image_path, "rb"),
+            model=EDIT_MODEL,
+            image=(os.path.basename(base_image_path), image_bytes, "image/png"),
             prompt=prompt,
-            size="1024x1024",
-            quality="high"
+            size=EDIT_SIZE,
+            quality=EDIT_QUALITY
         )
         
         print("API call successful!")
         
         if result.data and len(result.data) > 0:
-            image_data = result.data[0]
-            
-            # Check if we have base64 data or URL
-            if image_data.b64_json:
-                # Use base64 data
-                output_filename = f"rhythmojis/lego_{animal_name.replace(' ', '_')}.png"
-                with open(output_filename, "wb") as f:
-                    f.write(base64.b64decode(image_data.b64_json))
-                print(f"Saved: {output_filename} (from base64)")
-                return output_filename
-            elif image_data.url:
-                # Download from URL
-                print(f"Downloading from URL: {image_data.url}")
-                response = requests.get(image_data.url)
-                response.raise_for_status()
-                
-                output_filename = f"rhythmojis/lego_{animal_name.replace(' ', '_')}.png"
-                with open(output_filename, "wb") as f:
-                    f.write(response.content)
-                print(f"Saved: {output_filename} (from URL)")
-                return output_filename
-            else:
-                print("Error: No image data found in response")
-                return None
+            saved = _save_result_image(result.data[0], output_filename)
+            if saved:
+                # Cache upkeep is best-effort; the edit is already saved
+                try:
+                    os.makedirs(EDIT_CACHE_DIR, exist_ok=True)
+                    _link_or_copy(saved, cache_path)
+                    _prune_edit_cache()
+                except OSError as e:
+                    print(f"Warning: could not update edit cache: {e}")
+            return saved
         else:
             print("Error: No data in result")
             return None
@@ -0,0 +1,143 @@
+import base64, errno, io, os, types
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import lego_gen
+
+class FakeImages:
+    def __init__(self):
+        self.calls = 0
+    
+    def edit(self, **kwargs):
+        self.calls += 1
+        png = b"\x89PNG\r\n\x1a\nfake"
+        data = types.SimpleNamespace(b64_json=base64.b64encode(png).decode(), url=None)
+        return types.SimpleNamespace(data=[data])
+
+def test_repeated_edit_hits_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base = tmp_path / "base.png"
+    base.write_bytes(b"base image")
+    images = FakeImages()
+    monkeypatch.setattr(lego_gen, "client", types.SimpleNamespace(images=images))
+    
+    for _ in range(3):
+        assert lego_gen.edit_lego_head(str(base), "dog") == "rhythmojis/lego_dog.png"
+    
+    assert images.calls == 1
+    assert os.listdir("rhythmojis") == ["lego_dog.png"]
+    assert (tmp_path / "rhythmojis/lego_dog.png").read_bytes() == b"\x89PNG\r\n\x1a\nfake"
+
+def test_cache_store_failure_still_returns_saved_image(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base = tmp_path / "base.png"
+    base.write_bytes(b"base image")
+    monkeypatch.setattr(lego_gen, "client", types.SimpleNamespace(images=FakeImages()))
+    
+    def fail(*args):
+        raise PermissionError("read-only cache")
+    monkeypatch.setattr(lego_gen, "_link_or_copy", fail)
+    
+    assert lego_gen.edit_lego_head(str(base), "zebra") == "rhythmojis/lego_zebra.png"
+    assert (tmp_path / "rhythmojis/lego_zebra.png").exists()
+
+def test_missing_animal_name_skips_edit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    images = FakeImages()
+    monkeypatch.setattr(lego_gen, "client", types.SimpleNamespace(images=images))
+    
+    assert lego_gen.edit_lego_head("base.png", None) is None
+    assert lego_gen.edit_lego_head("base.png", "  ") is None
+    assert images.calls == 0
+
+def test_cache_hit_copies_when_hardlink_unsupported(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base = tmp_path / "base.png"
+    base.write_bytes(b"base image")
+    images = FakeImages()
+    monkeypatch.setattr(lego_gen, "client", types.SimpleNamespace(images=images))
+    
+    def no_link(src, dst):
+        raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+    monkeypatch.setattr(os, "link", no_link)
+    
+    assert lego_gen.edit_lego_head(str(base), "dog") == "rhythmojis/lego_dog.png"
+    os.remove("rhythmojis/lego_dog.png")
+    assert lego_gen.edit_lego_head(str(base), "dog") == "rhythmojis/lego_dog.png"
+    assert images.calls == 1
+    assert os.listdir("rhythmojis") == ["lego_dog.png"]
+
+def test_concurrent_edits_of_same_animal_all_succeed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(lego_gen, "client", types.SimpleNamespace(images=FakeImages()))
+    bases = []
+    for i in range(8):
+        base = tmp_path / f"base_{i}.png"
+        base.write_bytes(f"base image {i}".encode())
+        bases.append(str(base))
+    
+    # Another writer's in-progress temp must be left alone
+    os.makedirs("rhythmojis")
+    other_temp = tmp_path / "rhythmojis/lego_owl.png.tmp"
+    other_temp.write_bytes(b"in progress")
+    
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda b: lego_gen.edit_lego_head(b, "owl"), bases))
+    
+    assert results == ["rhythmojis/lego_owl.png"] * 8
+    assert other_temp.read_bytes() == b"in progress"
+    assert sorted(os.listdir("rhythmojis")) == ["lego_owl.png", "lego_owl.png.tmp"]
+
+def test_vanished_cache_entry_falls_back_to_edit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base = tmp_path / "base.png"
+    base.write_bytes(b"base image")
+    images = FakeImages()
+    monkeypatch.setattr(lego_gen, "client", types.SimpleNamespace(images=images))
+    assert lego_gen.edit_lego_head(str(base), "dog") == "rhythmojis/lego_dog.png"
+    
+    def pruned(src, dst):
+        raise FileNotFoundError(src)
+    monkeypatch.setattr(lego_gen, "_link_or_copy", pruned)
+    
+    assert lego_gen.edit_lego_head(str(base), "dog") == "rhythmojis/lego_dog.png"
+    assert images.calls == 2
+
+def test_base64_result_spanning_several_chunks(tmp_path):
+    png = os.urandom(3 * lego_gen.B64_CHUNK + 17)
+    data = types.SimpleNamespace(b64_json=base64.b64encode(png).decode(), url=None)
+    out = tmp_path / "out.png"
+    
+    assert lego_gen._save_result_image(data, str(out)) == str(out)
+    assert out.read_bytes() == png
+    assert os.listdir(tmp_path) == ["out.png"]
+
+class FakeResponse:
+    def __init__(self, body):
+        self.raw = io.BytesIO(body)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+    
+    def raise_for_status(self):
+        pass
+
+def test_url_result_is_streamed_to_disk(tmp_path, monkeypatch):
+    png = os.urandom(200000)
+    calls = []
+    def fake_get(url, **kwargs):
+        calls.append((url, kwargs))
+        return FakeResponse(png)
+    monkeypatch.setattr(lego_gen.SESSION, "get", fake_get)
+    data = types.SimpleNamespace(b64_json=None, url="https://example.com/img.png")
+    out = tmp_path / "out.png"
+    
+    assert lego_gen._save_result_image(data, str(out)) == str(out)
+    assert out.read_bytes() == png
+    assert os.listdir(tmp_path) == ["out.png"]
+    assert calls[0][0] == "https://example.com/img.png"
+    assert calls[0][1]["stream"] is True